@@ -1,31 +1,70 @@
 #!/usr/bin/env python3
 import itertools
 import argparse
+import codecs
+import fcntl
+import json
+import os
+import select
 import socket
+import sys
+import tempfile
+import termios
 import curses
 import time
-from multiprocessing import Process
-from subprocess import Popen, PIPE, DEVNULL
+import threading
+from subprocess import (Popen, PIPE, DEVNULL, CalledProcessError,
+                        check_output)
 import pychromecast
 import chardet
+try:
+    import chardetng_py
+except ImportError:
+    chardetng_py = None
 from twisted.web import http
 from twisted.web.server import Site, Request, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.internet import reactor, endpoints
-from twisted.web.static import File, Data, NoRangeStaticProducer
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.static import (File, StaticProducer,
+                                NoRangeStaticProducer,
+                                SingleRangeStaticProducer)
 from twisted.python.compat import networkString
+from zope.interface import implementer
 
 
 VIDEO_PATH = 'video'
 SUB_PATH = 'sub'
+VIDEO_PATH_B = VIDEO_PATH.encode('utf-8')
+SUB_PATH_B = SUB_PATH.encode('utf-8')
 DEFAULT_MIME = 'video/mp4'
 DEFAULT_BITRATE = '6000k'
+DETECT_CHUNK_SIZE = 16384
+SUBTITLE_BOMS = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+SENDFILE_CHUNK_SIZE = 1 << 20
+SOCKET_SNDBUF_SIZE = 1 << 20
+PIPE_SIZE = 1 << 20
+STATUS_UPDATE_INTERVAL = 1.0
+VOLUME_SEND_INTERVAL = 0.1
+COMPATIBLE_VIDEO_CODECS = {'h264'}
+COMPATIBLE_AUDIO_CODECS = {'aac'}
+COMPATIBLE_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+INCOMPATIBLE_PROFILES = ('High 10', '4:2:2', '4:4:4')
+
+_chardet_detector = None
+_chardet_lock = threading.Lock()
 
 
 def to_webvtt(sub_file, video_file=None):
+    """
+    Convert the subtitles to WebVTT, returning a file holding them, or None
+    if there are no subtitles.
+    """
     encoding = None
     if sub_file:
         encoding = detect_encoding(sub_file)
+    vtt_file = create_vtt_file()
+    vtt_fd = vtt_file.fileno()
     sub_transcoder = Popen(['ffmpeg',
                             '-y', '-nostdin'] +
                            (['-sub_charenc', encoding] if encoding else []) +
@@ -33,34 +72,80 @@ def to_webvtt(sub_file, video_file=None):
                             '-map', 's?',
                             '-f', 'webvtt',
                             '-loglevel', 'error',
-                            '-'],
-                           stdout=PIPE,
+                            f'pipe:{vtt_fd}'],
+                           pass_fds=[vtt_fd],
                            stderr=DEVNULL)
-    return sub_transcoder.stdout.read()
+    sub_transcoder.wait()
+    if os.fstat(vtt_fd).st_size == 0:
+        vtt_file.close()
+        return None
+    return vtt_file
+
+
+def create_vtt_file():
+    # an anonymous in-memory file where available, a temporary file otherwise
+    if hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd'):
+        return open(os.memfd_create('sub.vtt'), 'w+b')
+    return tempfile.NamedTemporaryFile(suffix='.vtt')
+
+
+def get_vtt_path(vtt_file):
+    # memfds have no name on disk, but can be reopened through /proc
+    if isinstance(vtt_file.name, int):
+        return f'/proc/self/fd/{vtt_file.fileno()}'
+    return vtt_file.name
 
 
 def detect_encoding(filename):
     with open(filename, 'rb') as f:
-        result = chardet.detect(f.read())
-        return result['encoding']
+        # ffmpeg decodes BOM-marked (UTF-8 or UTF-16) subtitles to UTF-8 by
+        # itself, and produces nothing if told they are UTF-16
+        if f.read(len(codecs.BOM_UTF8)).startswith(SUBTITLE_BOMS):
+            return 'UTF-8'
+        f.seek(0)
+        if chardetng_py:
+            detector = chardetng_py.EncodingDetector()
+            while chunk := f.read(DETECT_CHUNK_SIZE):
+                detector.feed(chunk, last=False)
+            detector.feed(b'', last=True)
+            return detector.guess(tld=None, allow_utf8=True)
+        with _chardet_lock:
+            detector = get_chardet_detector()
+            detector.reset()
+            while chunk := f.read(DETECT_CHUNK_SIZE):
+                detector.feed(chunk)
+                if detector.done:
+                    break
+            detector.close()
+            return detector.result['encoding']
+
+
+def get_chardet_detector():
+    # chardetng's detector cannot be reused once fed its last chunk,
+    # so only chardet's UniversalDetector is kept around
+    global _chardet_detector
+    if _chardet_detector is None:
+        _chardet_detector = chardet.UniversalDetector()
+    return _chardet_detector
 
 
-def serve(port, video_path, vtt_data, interface='',
-          chunked=False, transcode_bitrate=None):
-    if transcode_bitrate:
+def serve(port, video_path, vtt_file, interface='',
+          chunked=False, transcode_bitrate=None, remux=False):
+    if transcode_bitrate or remux:
         video = ChunkedPipe(get_transcoder(video_path, transcode_bitrate))
     elif chunked:
         video = ChunkedFile(video_path,
                             defaultType=DEFAULT_MIME)
     else:
-        video = File(video_path, defaultType=DEFAULT_MIME)
+        video = SendfileFile(video_path, defaultType=DEFAULT_MIME)
 
     root = Resource()
-    root.putChild(SUB_PATH.encode('utf-8'), Data(vtt_data, 'text/vtt'))
-    root.putChild(VIDEO_PATH.encode('utf-8'), video)
+    if vtt_file:
+        root.putChild(SUB_PATH_B, SendfileFile(get_vtt_path(vtt_file),
+                                               defaultType='text/vtt'))
+    root.putChild(VIDEO_PATH_B, video)
     endpoint = endpoints.TCP4ServerEndpoint(reactor, port, interface=interface)
     endpoint.listen(Site(root, requestFactory=CORSRequest))
-    reactor.run()
 
 
 class CORSRequest(Request):
@@ -69,6 +154,217 @@ class CORSRequest(Request):
         super().process()
 
 
+class SendfileFile(File):
+    def makeProducer(self, request, fileForReading):
+        producer = super().makeProducer(request, fileForReading)
+        if not can_sendfile(request):
+            return producer
+        if isinstance(producer, NoRangeStaticProducer):
+            return SendfileProducer(request, fileForReading,
+                                    0, self.getsize())
+        if isinstance(producer, SingleRangeStaticProducer):
+            return SendfileProducer(request, fileForReading,
+                                    producer.offset, producer.size)
+        return producer
+
+    def render_GET(self, request):
+        cork_socket(request)
+        return super().render_GET(request)
+
+
+def get_socket(request):
+    # TLS transports do not expose a plain socket to write to
+    get_handle = getattr(request.transport, 'getHandle', None)
+    handle = get_handle and get_handle()
+    return handle if isinstance(handle, socket.socket) else None
+
+
+def has_unsent_data(transport):
+    """
+    Whether Twisted still holds data (e.g. the response headers) that it
+    has not written to the transport's socket, or None if it can not tell.
+
+    There is no public signal for this: HTTPChannel drives pull producers
+    from a cooperator rather than from the transport draining its buffer,
+    so this peeks at FileDescriptor's write buffers.
+    """
+    try:
+        return bool(transport.dataBuffer or transport._tempDataBuffer)
+    except AttributeError:
+        return None
+
+
+def can_write_socket(request):
+    # the socket producers need the raw socket and a way to tell when
+    # Twisted is done writing the headers to it
+    return (get_socket(request) is not None and
+            has_unsent_data(request.transport) is not None)
+
+
+def can_sendfile(request):
+    return hasattr(os, 'sendfile') and can_write_socket(request)
+
+
+def cork_socket(request):
+    """
+    Enlarge the send buffer and hold back partial segments until the
+    response is finished, so that headers and video data leave the host
+    in full-sized packets.
+    """
+    sock = get_socket(request)
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF_SIZE)
+    if not hasattr(socket, 'TCP_CORK'):
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    def uncork(result):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        except OSError:
+            pass  # connection already closed
+
+    request.notifyFinish().addBoth(uncork)
+
+
+@implementer(IPushProducer)
+class SocketProducer(StaticProducer):
+    """
+    Base for producers that copy data straight to the client socket from a
+    worker thread, so that video data never goes through Python buffers.
+    Subclasses implement copy(), returning whether the whole response body
+    was sent.
+    """
+    def __init__(self, request, fileObject):
+        super().__init__(request, fileObject)
+        self.stopped = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        # writing no data still sends the status line and headers
+        self.request.write(b'')
+        self.chunked = self.request.chunked
+        self.waitForHeaders()
+
+    def waitForHeaders(self):
+        if self.stopped:
+            self.fileObject.close()
+            return
+        transport = self.request.transport
+        if has_unsent_data(transport):
+            reactor.callLater(0.01, self.waitForHeaders)
+            return
+        # the socket is dup'ed so that it can not be closed (and its fd
+        # number reused) under the worker thread
+        sock_fd = os.dup(transport.getHandle().fileno())
+        reactor.callInThread(self.run, sock_fd)
+
+    def run(self, sock_fd):
+        complete = False
+        try:
+            complete = self.copy(sock_fd)
+        except OSError:
+            pass  # client went away
+        finally:
+            os.close(sock_fd)
+            reactor.callFromThread(self.sendDone, complete)
+
+    def copy(self, sock_fd):
+        raise NotImplementedError(self.copy)
+
+    def sendDone(self, complete):
+        self.fileObject.close()
+        if self.stopped:
+            return
+        request, self.request = self.request, None
+        self.stopped = True
+        request.unregisterProducer()
+        if complete:
+            request.finish()
+        else:
+            request.loseConnection()
+
+    def pauseProducing(self):
+        # data bypasses the transport buffer, so there is nothing to throttle
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        # the file is closed by whoever is currently using it
+        self.stopped = True
+        self.request = None
+
+
+class SendfileProducer(SocketProducer):
+    """
+    Sends a byte range of a regular file using sendfile(2).
+    """
+    def __init__(self, request, fileObject, offset, size):
+        super().__init__(request, fileObject)
+        self.offset = offset
+        self.bytesLeft = size
+
+    def copy(self, sock_fd):
+        file_fd = self.fileObject.fileno()
+        while self.bytesLeft > 0 and not self.stopped:
+            select.select([], [sock_fd], [], 1)
+            try:
+                sent = os.sendfile(sock_fd, file_fd, self.offset,
+                                   min(self.bytesLeft, SENDFILE_CHUNK_SIZE))
+            except BlockingIOError:
+                continue
+            if sent == 0:
+                break
+            self.offset += sent
+            self.bytesLeft -= sent
+        return self.bytesLeft == 0
+
+
+class SplicePipeProducer(SocketProducer):
+    """
+    Moves everything readable from a pipe to the socket using splice(2),
+    adding the chunked transfer-encoding framing by hand when needed.
+    """
+    def copy(self, sock_fd):
+        pipe_fd = self.fileObject.fileno()
+        while not self.stopped:
+            readable, _, _ = select.select([pipe_fd], [], [], 1)
+            if not readable:
+                continue
+            size = bytes_available(pipe_fd)
+            if size == 0:
+                return True  # end of file
+            if self.chunked:
+                write_all(sock_fd, b'%x\r\n' % size)
+            while size > 0:
+                select.select([], [sock_fd], [], 1)
+                try:
+                    size -= os.splice(pipe_fd, sock_fd, size)
+                except BlockingIOError:
+                    continue
+            if self.chunked:
+                write_all(sock_fd, b'\r\n')
+        return False
+
+
+def bytes_available(fd):
+    buf = bytearray(4)
+    fcntl.ioctl(fd, termios.FIONREAD, buf)
+    return int.from_bytes(buf, sys.byteorder)
+
+
+def write_all(fd, data):
+    while data:
+        select.select([], [fd], [], 1)
+        try:
+            data = data[os.write(fd, data):]
+        except BlockingIOError:
+            pass
+
+
 class ChunkedFile(File):
     def makeProducer(self, request, fileForReading):
         self._setContentHeaders(request)
@@ -76,6 +372,7 @@ class ChunkedFile(File):
         return NoRangeStaticProducer(request, fileForReading)
 
     def render_GET(self, request):
+        cork_socket(request)
         res = super().render_GET(request)
         request.responseHeaders.removeHeader(b'accept-ranges')
         request.responseHeaders.removeHeader(b'content-length')
@@ -92,10 +389,17 @@ class ChunkedPipe(ChunkedFile):
         if request.method == b'HEAD':
             self._setContentHeaders(request)
             return b''
+        cork_socket(request)
         producer = self.makeProducer(request, self.fileForReading)
         producer.start()
         return NOT_DONE_YET
 
+    def makeProducer(self, request, fileForReading):
+        producer = super().makeProducer(request, fileForReading)
+        if hasattr(os, 'splice') and can_write_socket(request):
+            return SplicePipeProducer(request, fileForReading)
+        return producer
+
     def _setContentHeaders(self, request, size=None):
         if self.type:
             request.setHeader(b'content-type', networkString(self.type))
@@ -109,25 +413,89 @@ def get_src_ip_addr(dest_addr='8.8.8.8', dest_port=53):
 
 
 def find_cast(friendly_name=None):
+    # the browsers are left running, as the casts resolve their mDNS
+    # services through them when (re)connecting
+    if friendly_name:
+        # returns as soon as the named device shows up
+        chromecasts, unused = pychromecast.get_listed_chromecasts(
+            friendly_names=[friendly_name])
+        return chromecasts[0]
     chromecasts, unused = pychromecast.get_chromecasts()
-    return next(cc for cc in chromecasts
-                if not friendly_name or
-                cc.device.friendly_name == friendly_name)
+    return chromecasts[0]
 
 
-def get_transcoder(infile, video_bitrate):
+def probe(infile):
+    # returns None if the file can not be probed, so that it gets transcoded
+    try:
+        output = check_output(['ffprobe',
+                               '-v', 'quiet',
+                               '-print_format', 'json',
+                               '-show_format',
+                               '-show_streams',
+                               infile])
+    except (CalledProcessError, OSError):
+        return None
+    return json.loads(output)
+
+
+def is_compatible(info):
+    streams = info.get('streams', [])
+    video = [st for st in streams if st.get('codec_type') == 'video']
+    audio = [st for st in streams if st.get('codec_type') == 'audio']
+    return (bool(video) and
+            all(is_compatible_video(st) for st in video) and
+            all(st.get('codec_name') in COMPATIBLE_AUDIO_CODECS
+                for st in audio))
+
+
+def is_compatible_video(stream):
+    # the ChromeCast only decodes 8-bit 4:2:0 H.264, so e.g. Hi10P
+    # streams still need re-encoding
+    profile = stream.get('profile', '')
+    return (stream.get('codec_name') in COMPATIBLE_VIDEO_CODECS and
+            stream.get('pix_fmt') in COMPATIBLE_PIX_FMTS and
+            not any(p in profile for p in INCOMPATIBLE_PROFILES))
+
+
+def is_mp4(info):
+    format_names = info.get('format', {}).get('format_name', '')
+    return 'mp4' in format_names.split(',')
+
+
+def get_transcoder(infile, video_bitrate=None):
+    """
+    Start ffmpeg producing a fragmented mp4 on its stdout. Without a
+    video_bitrate the streams are only remuxed, not re-encoded.
+    """
+    if video_bitrate:
+        codec_args = ['-threads', '0',
+                      '-preset', 'ultrafast',
+                      '-tune', 'zerolatency',
+                      '-x264opts', 'keyint=60:min-keyint=60:no-scenecut',
+                      '-flags', 'low_delay',
+                      '-b:v', video_bitrate,
+                      '-vcodec', 'h264',
+                      '-acodec', 'aac']
+    else:
+        codec_args = ['-c:v', 'copy',
+                      '-c:a', 'copy']
     transcoder = Popen(['ffmpeg',
                         '-y', '-nostdin',
-                        '-i', infile,
-                        '-preset', 'ultrafast',
-                        '-f', 'mp4',
+                        '-fflags', '+nobuffer',
+                        '-i', infile] +
+                       codec_args +
+                       ['-f', 'mp4',
+                        '-movflags',
+                        '+frag_keyframe+empty_moov+default_base_moof',
                         '-frag_duration', '3000',
-                        '-b:v', video_bitrate,
                         '-loglevel', 'error',
-                        '-vcodec', 'h264',
-                        '-acodec', 'aac',
                         '-'],
                        stdout=PIPE)
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        try:
+            fcntl.fcntl(transcoder.stdout, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            pass  # keep the default size if over the system limit
     return transcoder.stdout
 
 
@@ -150,46 +518,78 @@ def control_loop(cast, mc, unseekable=False):
     stdscr.nodelay(True)
 
     started = False
+    last_update = 0.0
+    pending_volume = None
+    sent_volume = reported_volume = None
+    last_volume_send = 0.0
 
     try:
         while True:
             try:
-                c = stdscr.getch()
-                if c == curses.ERR:
-                    time.sleep(1)
-                elif c == ord(' '):
-                    if mc.status.player_state == 'PAUSED':
-                        mc.play()
-                    else:
-                        mc.pause()
-                elif c == ord('q'):
+                keys = read_keys(stdscr)
+                if not keys:
+                    time.sleep(VOLUME_SEND_INTERVAL
+                               if pending_volume is not None else 1)
+                # snapshot after sleeping, so that it includes the reply to
+                # the previous update_status()
+                st = mc.status
+                pstate = st.player_state if st else None
+                ct = st.current_time if st else 0
+                vol = cast.status.volume_level
+                if pending_volume is not None:
+                    vol = pending_volume
+                elif sent_volume is not None and vol == reported_volume:
+                    # the cast has not reported the last change yet, so
+                    # further presses must build on what was sent
+                    vol = sent_volume
+                if ord('q') in keys:
                     mc.stop()
                     break
-                elif c == curses.KEY_RIGHT and not unseekable:
-                    mc.seek(mc.status.current_time + 10)
-                elif c == curses.KEY_LEFT and not unseekable:
-                    mc.seek(max(mc.status.current_time - 10, 0))
-                elif c == curses.KEY_PPAGE and not unseekable:
-                    mc.seek(mc.status.current_time + 60)
-                elif c == curses.KEY_NPAGE and not unseekable:
-                    mc.seek(max(mc.status.current_time - 60, 0))
-                elif c == curses.KEY_UP:
-                    cast.set_volume(min(cast.status.volume_level + 0.1, 1))
-                elif c == curses.KEY_DOWN:
-                    cast.set_volume(max(cast.status.volume_level - 0.1, 0))
-                if mc.status:
-                    stdscr.addstr(0, 0, mc.status.player_state)
+                paused = pstate == 'PAUSED'
+                seek_delta = 0
+                for c in keys:
+                    if c == ord(' '):
+                        if paused:
+                            mc.play()
+                        else:
+                            mc.pause()
+                        paused = not paused
+                    elif c == curses.KEY_RIGHT and not unseekable:
+                        seek_delta += 10
+                    elif c == curses.KEY_LEFT and not unseekable:
+                        seek_delta -= 10
+                    elif c == curses.KEY_PPAGE and not unseekable:
+                        seek_delta += 60
+                    elif c == curses.KEY_NPAGE and not unseekable:
+                        seek_delta -= 60
+                    elif c == curses.KEY_UP:
+                        vol = pending_volume = min(round(vol + 0.1, 2), 1)
+                    elif c == curses.KEY_DOWN:
+                        vol = pending_volume = max(round(vol - 0.1, 2), 0)
+                if seek_delta:
+                    # one seek for all the presses read in this iteration
+                    mc.seek(max(ct + seek_delta, 0))
+                now = time.monotonic()
+                if (pending_volume is not None and
+                        now - last_volume_send >= VOLUME_SEND_INTERVAL):
+                    reported_volume = cast.status.volume_level
+                    sent_volume = cast.set_volume(pending_volume)
+                    pending_volume = None
+                    last_volume_send = now
+                if st and now - last_update >= STATUS_UPDATE_INTERVAL:
+                    stdscr.addstr(0, 0, pstate)
                     stdscr.clrtoeol()
-                    minutes, seconds = divmod(mc.status.current_time, 60)
+                    minutes, seconds = divmod(int(ct), 60)
                     hours, minutes = divmod(minutes, 60)
-                    stdscr.addstr(1, 0, "%02i:%02i:%02i"
-                                        % (hours, minutes, seconds))
-                    idle_state = mc.status.player_state == 'IDLE'
+                    stdscr.addstr(1, 0,
+                                  f"{hours:02d}:{minutes:02d}:{seconds:02d}")
+                    idle_state = pstate == 'IDLE'
                     if not idle_state:
                         started = True
                     if started and idle_state:
                         break
                     mc.update_status()
+                    last_update = now
                 stdscr.move(2, 0)
                 stdscr.refresh()
             except pychromecast.error.UnsupportedNamespace:
@@ -201,6 +601,12 @@ def control_loop(cast, mc, unseekable=False):
         curses.endwin()
 
 
+def read_keys(stdscr):
+    # drain all pending input, so that every press is handled before the
+    # status is polled again
+    return list(iter(stdscr.getch, curses.ERR))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--video', required=True,
@@ -209,7 +615,9 @@ def main():
                         help='Unseekable stream using chunked-encoding '
                         '(for incomplete files)')
     parser.add_argument('-t', '--transcode', action='store_true',
-                        help='Transcode to mp4 using ffmpeg (implies -c)')
+                        help='Transcode to mp4 using ffmpeg, only remuxing '
+                        'or serving as is when the codecs are supported '
+                        '(implies -c, except for compatible mp4 files)')
     parser.add_argument('-b', '--bitrate',
                         help='Video bitrate for transcoding (implies -t)')
     parser.add_argument('-s', '--subtitles',
@@ -229,24 +637,31 @@ def main():
 
     video = args.video
     transcode = args.transcode or args.bitrate
-    chunked = transcode or args.chunked
+    remux = False
+    if args.transcode and not args.bitrate:
+        # avoid re-encoding streams the ChromeCast can already play
+        info = probe(video)
+        if info and is_compatible(info):
+            transcode = False
+            remux = not is_mp4(info)
+    chunked = transcode or remux or args.chunked
     transcode_bitrate = transcode and (args.bitrate or DEFAULT_BITRATE)
     subtitles = to_webvtt(args.subtitles, video)
 
-    base_url = 'http://{}:{}'.format(ip, port)
-    video_url = '{}/{}'.format(base_url, VIDEO_PATH)
-    sub_url = subtitles and '{}/{}'.format(base_url, SUB_PATH)
-
-    server = Process(target=serve,
-                     args=(port,
-                           video,
-                           subtitles,
-                           ip,
-                           chunked,
-                           transcode_bitrate))
+    base_url = f'http://{ip}:{port}'
+    video_url = f'{base_url}/{VIDEO_PATH}'
+    sub_url = subtitles and f'{base_url}/{SUB_PATH}'
+
+    serve(port, video, subtitles, ip, chunked, transcode_bitrate, remux)
+    # curses and Ctrl-C stay in the main thread with the control loop
+    server = threading.Thread(target=reactor.run,
+                              kwargs={'installSignalHandlers': False},
+                              daemon=True)
     server.start()
-    play(cast, video_url, sub_url=sub_url, unseekable=chunked)
-    server.terminate()
+    try:
+        play(cast, video_url, sub_url=sub_url, unseekable=chunked)
+    finally:
+        reactor.callFromThread(reactor.stop)
 
 
 if __name__ == '__main__':